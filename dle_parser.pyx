@@ -0,0 +1,48 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""C implementation of the DLE frame extractor.
+
+Build in place with ``python setup.py build_ext --inplace`` (requires
+Cython).  planefinder_client falls back to the pure-Python
+DLEProtocol.extract_frames when this extension is not built.
+"""
+
+
+def extract_frames(const unsigned char[::1] buf):
+    """Mirror of DLEProtocol.extract_frames: returns ``(frames, consumed)``.
+
+    The scanning runs over C unsigned chars with C integer indices, so
+    no Python objects are touched until a complete frame is emitted.
+    """
+    cdef Py_ssize_t n = buf.shape[0]
+    cdef Py_ssize_t pos = 0
+    cdef Py_ssize_t i, j, end
+    frames = []
+    while True:
+        # Locate the DLE/STX frame start.
+        i = pos
+        while i < n - 1 and not (buf[i] == 0x10 and buf[i + 1] == 0x02):
+            i += 1
+        if i >= n - 1:
+            # No frame start left; keep a trailing DLE in case the STX
+            # arrives in the next chunk.
+            pos = n - 1 if n > 0 and buf[n - 1] == 0x10 else n
+            break
+        # Locate the DLE/ETX terminator, skipping stuffed DLE/DLE pairs.
+        j = i + 2
+        end = -1
+        while j < n - 1:
+            if buf[j] == 0x10:
+                if buf[j + 1] == 0x10:
+                    j += 2
+                    continue
+                if buf[j + 1] == 0x03:
+                    end = j
+                    break
+            j += 1
+        if end < 0:
+            # Partial frame at the end of the buffer.
+            pos = i
+            break
+        frames.append(bytes(buf[i + 2:end]).replace(b"\x10\x10", b"\x10"))
+        pos = end + 2
+    return frames, pos
@@ -0,0 +1,532 @@
+"""KML/KMZ generation for live aircraft display in Google Earth.
+
+Keeps a small in-memory database of recently seen aircraft and renders
+it as a minimal KML document: one placemark per aircraft plus a short
+line showing the predicted position 30 seconds ahead.  The document is
+packed into a KMZ (zipped KML) for Google Earth's NetworkLink refresh.
+"""
+
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+# Seconds of travel to project forward for the prediction line.
+PREDICTION_SECONDS = 30.0
+# Mean Earth radius used for the flat-earth projection, in metres.
+EARTH_RADIUS_M = 6378137.0
+KNOTS_TO_MS = 0.514444
+
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">'
+    "<Document>"
+    '<Style id="aircraft">'
+    "<IconStyle><scale>0.6</scale>"
+    "<Icon><href>http://maps.google.com/mapfiles/kml/shapes/airports.png</href></Icon>"
+    "</IconStyle>"
+    "<LabelStyle><scale>0.7</scale></LabelStyle>"
+    "</Style>"
+    '<Style id="prediction">'
+    "<LineStyle><color>7f00ffff</color><width>2</width></LineStyle>"
+    "</Style>"
+)
+KML_FOOTER = "</Document></kml>"
+
+_STATIC_PREFIX = KML_HEADER.encode("utf-8")
+_KMZ_FILENAME = b"doc.kml"
+
+
+# Constant parts of the one-entry ZIP container, packed once at import:
+# only the CRC, the two sizes and the central-directory offset change
+# between calls.  The single entry always sits at offset 0 with a fixed
+# name, so everything else is a byte template.
+_LFH_PREFIX = struct.pack("<4sHHHHH", b"PK\x03\x04", 20, 0, 8, 0, 0)
+_LFH_SUFFIX = struct.pack("<HH", len(_KMZ_FILENAME), 0) + _KMZ_FILENAME
+_CDH_PREFIX = struct.pack("<4sHHHHHH", b"PK\x01\x02", 20, 20, 0, 8, 0, 0)
+_CDH_SUFFIX = struct.pack("<HHHHHII", len(_KMZ_FILENAME), 0, 0, 0, 0, 0, 0) + _KMZ_FILENAME
+_CDH_LEN = len(_CDH_PREFIX) + 12 + len(_CDH_SUFFIX)
+_LFH_LEN = len(_LFH_PREFIX) + 12 + len(_LFH_SUFFIX)
+_SIZES = struct.Struct("<III")
+_EOCD_PREFIX = struct.pack("<4sHHHHI", b"PK\x05\x06", 0, 0, 1, 1, _CDH_LEN)
+_EOCD_TAIL = struct.Struct("<IH")
+
+
+def _build_kmz(compressed, crc, uncompressed_size):
+    """Wrap a raw deflate stream in a one-entry ZIP container (= KMZ)."""
+    sizes = _SIZES.pack(crc, len(compressed), uncompressed_size)
+    return b"".join(
+        (
+            _LFH_PREFIX,
+            sizes,
+            _LFH_SUFFIX,
+            compressed,
+            _CDH_PREFIX,
+            sizes,
+            _CDH_SUFFIX,
+            _EOCD_PREFIX,
+            _EOCD_TAIL.pack(_LFH_LEN + len(compressed), 0),
+        )
+    )
+
+
+# Per-aircraft fragments are rendered through precompiled %-templates so
+# the hot loop does one format call and one list append per placemark.
+AIRCRAFT_TMPL = (
+    "<Placemark><name>%s</name><styleUrl>#aircraft</styleUrl>"
+    "<Point><coordinates>%.6f,%.6f</coordinates></Point></Placemark>"
+)
+PREDICTION_TMPL = (
+    "<Placemark><styleUrl>#prediction</styleUrl><LineString>"
+    "<coordinates>%.6f,%.6f %.6f,%.6f</coordinates></LineString></Placemark>"
+)
+
+
+# cos(latitude) at one-degree resolution, linearly interpolated in
+# _predict_position.  Interpolated error is ~4e-5 relative, far below
+# display precision, and two index-and-multiplies are much cheaper than
+# a transcendental call per aircraft.  The extra entry past 90 keeps
+# the interpolation index in range at the pole.
+_COS_LAT = [math.cos(math.radians(deg)) for deg in range(-90, 92)]
+
+
+def _predict_position(lat, lon, speed, heading):
+    """Project (*lat*, *lon*) forward along *heading* for the prediction window."""
+    heading_rad = math.radians(heading)
+    distance = speed * KNOTS_TO_MS * PREDICTION_SECONDS
+    # Feed data arrives unvalidated, so clamp to the table's domain:
+    # math.cos tolerated any float, and an out-of-range latitude must
+    # degrade to a pole-ish projection rather than an IndexError that
+    # fails every render until the entry expires.
+    index = lat + 90.0
+    if index < 0.0:
+        index = 0.0
+    elif index > 180.0:
+        index = 180.0
+    whole = int(index)
+    low = _COS_LAT[whole]
+    cos_lat = low + (_COS_LAT[whole + 1] - low) * (index - whole)
+    pred_lat = lat + (
+        distance * math.cos(heading_rad) / EARTH_RADIUS_M * (180.0 / math.pi)
+    )
+    pred_lon = lon + (
+        distance * math.sin(heading_rad)
+        / (EARTH_RADIUS_M * cos_lat)
+        * (180.0 / math.pi)
+    )
+    return pred_lat, pred_lon
+
+
+def _compute_predictions(aircraft_list):
+    """Compute predicted positions for all of *aircraft_list* at once.
+
+    Returns a list aligned with the input containing ``(pred_lat,
+    pred_lon)`` tuples, or ``None`` where an aircraft has no usable
+    speed/heading.  When NumPy is available the trig runs as a handful
+    of vector operations over all aircraft instead of per-aircraft
+    math calls.
+    """
+    if _np is None or len(aircraft_list) < 2:
+        return [
+            _predict_position(
+                a["lat_e6"] * 1e-6,
+                a["lon_e6"] * 1e-6,
+                a["speed_e1"] * 0.1,
+                a["heading_e1"] * 0.1,
+            )
+            if a["speed_e1"] and a["heading_e1"] is not None
+            else None
+            for a in aircraft_list
+        ]
+    lats = _np.array([a["lat_e6"] for a in aircraft_list], dtype=_np.float64)
+    lats *= 1e-6
+    lons = _np.array([a["lon_e6"] for a in aircraft_list], dtype=_np.float64)
+    lons *= 1e-6
+    speeds = _np.array(
+        [a["speed_e1"] for a in aircraft_list], dtype=_np.float64
+    )
+    speeds *= 0.1
+    headings = _np.array(
+        [
+            a["heading_e1"] if a["heading_e1"] is not None else 0
+            for a in aircraft_list
+        ],
+        dtype=_np.float64,
+    )
+    headings *= 0.1
+    heading_rad = _np.radians(headings)
+    distance = speeds * (KNOTS_TO_MS * PREDICTION_SECONDS)
+    deg = 180.0 / math.pi
+    pred_lats = lats + distance * _np.cos(heading_rad) / EARTH_RADIUS_M * deg
+    pred_lons = lons + (
+        distance * _np.sin(heading_rad)
+        / (EARTH_RADIUS_M * _np.cos(_np.radians(lats)))
+        * deg
+    )
+    return [
+        (pred_lats[i], pred_lons[i])
+        if aircraft_list[i]["speed_e1"] and aircraft_list[i]["heading_e1"] is not None
+        else None
+        for i in range(len(aircraft_list))
+    ]
+
+
+class OptimizedKMZGenerator:
+    """Maintains the aircraft database and renders it as KML/KMZ."""
+
+    def __init__(self, persistence_time=60.0, compresslevel=1, flush_interval=0.5):
+        self.persistence_time = persistence_time
+        # Incoming payloads are queued and merged in one pass at most
+        # every flush_interval seconds (or when a reader needs fresh
+        # data), so several payloads arriving within one refresh share
+        # a single database rebuild.
+        self.flush_interval = flush_interval
+        # Level 1 roughly triples deflate throughput over the zlib
+        # default for XML at a few percent size penalty, which is the
+        # right trade at a one-second refresh cadence.
+        self.compresslevel = compresslevel
+        # Ordered oldest-first by last_seen_timestamp, so expiry only
+        # ever inspects the front.
+        self.aircraft_database = OrderedDict()
+        self._lock = threading.Lock()
+        self.last_update_ts = None
+        self.update_count = 0
+        # Deflate state captured after compressing the static KML
+        # prefix, so refreshes never recompress the header/styles.
+        self._prefix_deflate = None
+        # Bumped only when an update actually changes what would be
+        # rendered; lets the KML build be skipped for heartbeat-only
+        # ticks.
+        self._data_version = 0
+        self._kml_cache = None
+        # Prediction placemarks emitted by the most recent KML render.
+        self.last_prediction_count = 0
+        # (version, snapshot) pair reused by get_current_aircraft while
+        # the data hasn't changed.
+        self._aircraft_snapshot = None
+        # Set whenever the data version moves, so consumers (the web
+        # server's KMZ producer) can rebuild eagerly instead of polling.
+        self.data_changed = threading.Event()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+        self._flush_thread = None
+
+    def update_aircraft_data(self, aircraft_list):
+        """Queue *aircraft_list* for the next database merge.
+
+        Payloads are coalesced: the queue is drained by the flush
+        thread every flush_interval seconds, or synchronously by the
+        first reader that needs current data.
+        """
+        with self._pending_lock:
+            self._pending.append(aircraft_list)
+        if self._flush_thread is None:
+            self._start_flush_thread()
+
+    def _start_flush_thread(self):
+        with self._pending_lock:
+            if self._flush_thread is not None:
+                return
+            self._flush_thread = threading.Thread(
+                target=self._flush_loop, daemon=True
+            )
+        self._flush_thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            # The feed is unvalidated, so a malformed record (say a
+            # string latitude) can raise out of the merge; log and keep
+            # the thread alive rather than silently losing coalescing
+            # for the rest of the process.
+            try:
+                self._flush_pending()
+            except Exception as exc:
+                print(f"Flush error: {exc}")
+
+    def _flush_pending(self):
+        if not self._pending:
+            return
+        with self._apply_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            merged = []
+            for aircraft_list in pending:
+                merged.extend(aircraft_list)
+            self._apply_updates(merged)
+
+    def _apply_updates(self, aircraft_list):
+        """Merge *aircraft_list* into the database and expire stale entries."""
+        # Monotonic timestamps drive the persistence window so wall-
+        # clock jumps can't mass-expire (or immortalize) aircraft; the
+        # wall-clock time is kept as a plain float and only formatted
+        # when the status is actually displayed.
+        now = time.monotonic()
+        # Build the next database outside the lock and publish it with a
+        # single reference swap, so readers and the ingest thread only
+        # ever hold the lock for a pointer grab.
+        with self._lock:
+            new_db = OrderedDict(self.aircraft_database)
+        changed = False
+        for aircraft in aircraft_list:
+            aircraft_id = aircraft.get("aircraft_id")
+            if not aircraft_id:
+                continue
+            # DataProcessor always emits fully-populated dicts, so
+            # direct indexing is the hot path; the except branch only
+            # runs for partial dicts from direct callers.
+            try:
+                callsign = aircraft["callsign"] or aircraft_id
+                lat = aircraft["lat"]
+                lon = aircraft["lon"]
+                altitude = aircraft["altitude"]
+                speed = aircraft["speed"]
+                heading = aircraft["heading"]
+            except KeyError:
+                callsign = aircraft.get("callsign") or aircraft_id
+                lat = aircraft.get("lat")
+                lon = aircraft.get("lon")
+                altitude = aircraft.get("altitude")
+                speed = aircraft.get("speed")
+                heading = aircraft.get("heading")
+            # Quantize on ingest: micro-degrees, whole feet and tenths
+            # of a knot/degree are well inside display precision, make
+            # the entries smaller, and turn change detection into exact
+            # integer compares.
+            lat_e6 = None if lat is None else round(lat * 1e6)
+            lon_e6 = None if lon is None else round(lon * 1e6)
+            altitude = int(altitude or 0)
+            speed_e1 = round((speed or 0) * 10)
+            heading_e1 = None if heading is None else round(heading * 10)
+            existing = new_db.get(aircraft_id)
+            if existing is not None:
+                # Entry dicts are shared with published snapshots that
+                # renders walk without the lock, so a changed entry is
+                # replaced with a fresh dict (copy-on-write) rather
+                # than edited in place — an in-flight render may still
+                # be reading, or writing _kml_frag into, the old one.
+                # The unchanged majority keeps its dict (and cached
+                # fragment); refreshing the timestamp is a single item
+                # store, harmless to concurrent readers.
+                if (
+                    existing["callsign"] != callsign
+                    or existing["lat_e6"] != lat_e6
+                    or existing["lon_e6"] != lon_e6
+                    or existing["altitude"] != altitude
+                    or existing["speed_e1"] != speed_e1
+                    or existing["heading_e1"] != heading_e1
+                ):
+                    new_db[aircraft_id] = {
+                        "aircraft_id": aircraft_id,
+                        "callsign": callsign,
+                        "lat_e6": lat_e6,
+                        "lon_e6": lon_e6,
+                        "altitude": altitude,
+                        "speed_e1": speed_e1,
+                        "heading_e1": heading_e1,
+                        "last_seen_timestamp": now,
+                    }
+                    changed = True
+                else:
+                    existing["last_seen_timestamp"] = now
+                new_db.move_to_end(aircraft_id)
+            else:
+                changed = True
+                new_db[aircraft_id] = {
+                    "aircraft_id": aircraft_id,
+                    "callsign": callsign,
+                    "lat_e6": lat_e6,
+                    "lon_e6": lon_e6,
+                    "altitude": altitude,
+                    "speed_e1": speed_e1,
+                    "heading_e1": heading_e1,
+                    "last_seen_timestamp": now,
+                }
+        # Entries are ordered by last_seen_timestamp, so expiry pops
+        # from the front until it hits a live entry: O(expired) rather
+        # than a full walk of the database.
+        cutoff = now - self.persistence_time
+        while new_db:
+            oldest = next(iter(new_db.values()))
+            if oldest["last_seen_timestamp"] >= cutoff:
+                break
+            new_db.popitem(last=False)
+            changed = True
+        with self._lock:
+            self.aircraft_database = new_db
+            self.last_update_ts = time.time()
+            self.update_count += 1
+            if changed:
+                self._data_version += 1
+        if changed:
+            self.data_changed.set()
+
+    def set_compresslevel(self, compresslevel):
+        """Change the deflate level, discarding cached compressor state."""
+        self.compresslevel = compresslevel
+        self._prefix_deflate = None
+
+    def version(self):
+        """Monotonic counter bumped whenever rendered data changes.
+
+        Lets callers cache derived artifacts (KML, KMZ bytes) and
+        regenerate only when this value moves.
+        """
+        self._flush_pending()
+        with self._lock:
+            return self._data_version
+
+    def get_current_aircraft(self):
+        """Return a snapshot list of all tracked aircraft.
+
+        Ages are computed here, on demand, rather than being written
+        into every entry on every update.  The snapshot is a tuple
+        cached against the data version, so the several callers per
+        request share one build instead of each copying the database
+        (ages are as of the first call after a change, which is close
+        enough for display).
+        """
+        self._flush_pending()
+        with self._lock:
+            db = self.aircraft_database
+            version = self._data_version
+        cached = self._aircraft_snapshot
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        now = time.monotonic()
+        snapshot = []
+        for entry in db.values():
+            lat_e6 = entry["lat_e6"]
+            lon_e6 = entry["lon_e6"]
+            heading_e1 = entry["heading_e1"]
+            snapshot.append(
+                {
+                    "aircraft_id": entry["aircraft_id"],
+                    "callsign": entry["callsign"],
+                    "lat": None if lat_e6 is None else lat_e6 * 1e-6,
+                    "lon": None if lon_e6 is None else lon_e6 * 1e-6,
+                    "altitude": entry["altitude"],
+                    "speed": entry["speed_e1"] * 0.1,
+                    "heading": None if heading_e1 is None else heading_e1 * 0.1,
+                    "age_seconds": now - entry["last_seen_timestamp"],
+                }
+            )
+        snapshot = tuple(snapshot)
+        self._aircraft_snapshot = (version, snapshot)
+        return snapshot
+
+    def get_system_status(self):
+        """Return a status summary dict for the /status endpoint."""
+        self._flush_pending()
+        with self._lock:
+            db = self.aircraft_database
+            last_update_ts = self.last_update_ts
+            update_count = self.update_count
+        aircraft_count = len(db)
+        return {
+            "aircraft_count": aircraft_count,
+            "update_count": update_count,
+            "last_update": (
+                datetime.fromtimestamp(last_update_ts, timezone.utc).isoformat()
+                if last_update_ts
+                else None
+            ),
+            "persistence_time": self.persistence_time,
+        }
+
+    def generate_minimal_kml(self):
+        """Render the current aircraft database as a KML string."""
+        self._flush_pending()
+        with self._lock:
+            db = self.aircraft_database
+            version = self._data_version
+        cached = self._kml_cache
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        entries = list(db.values())
+        drawable = [
+            e for e in entries
+            if e["lat_e6"] is not None and e["lon_e6"] is not None
+        ]
+        # Only aircraft without a cached fragment need the math and the
+        # formatting; everything else is emitted verbatim below.
+        fresh = [e for e in drawable if "_kml_frag" not in e]
+        predictions = _compute_predictions(fresh)
+        for entry, prediction in zip(fresh, predictions):
+            lat = entry["lat_e6"] * 1e-6
+            lon = entry["lon_e6"] * 1e-6
+            formatted_altitude = (
+                f"{entry['callsign']} {round(entry['altitude'] / 100)}"
+            )
+            frag = AIRCRAFT_TMPL % (formatted_altitude, lon, lat)
+            if prediction is not None:
+                pred_lat, pred_lon = prediction
+                frag += PREDICTION_TMPL % (lon, lat, pred_lon, pred_lat)
+            entry["_kml_frag"] = frag
+            entry["_has_pred"] = prediction is not None
+        kml_parts = [KML_HEADER]
+        kml_parts.extend(entry["_kml_frag"] for entry in drawable)
+        kml_parts.append(KML_FOOTER)
+        kml = "".join(kml_parts)
+        # Tallied from the per-entry flag set alongside each fragment, so
+        # callers wanting the count don't have to scan the KML string.
+        self.last_prediction_count = sum(
+            1 for entry in drawable if entry["_has_pred"]
+        )
+        self._kml_cache = (version, kml)
+        return kml
+
+    def generate_main_kml(self, base_url):
+        """Render the top-level NetworkLink document pointing at *base_url*."""
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<kml xmlns="http://www.opengis.net/kml/2.2">'
+            "<Document>"
+            "<name>Planefinder Live</name>"
+            "<NetworkLink>"
+            "<name>Aircraft</name>"
+            "<Link>"
+            f"<href>{base_url}/aircraft.kmz</href>"
+            "<refreshMode>onInterval</refreshMode>"
+            "<refreshInterval>1</refreshInterval>"
+            "</Link>"
+            "</NetworkLink>"
+            "</Document></kml>"
+        )
+
+    def create_kmz_from_kml(self, kml_content):
+        """Pack *kml_content* into KMZ (a one-entry ZIP) and return the bytes.
+
+        The static document prefix (XML declaration plus styles) never
+        changes between refreshes, so its deflate output and compressor
+        state are computed once and reused: each call only compresses
+        the dynamic placemark section.
+        """
+        kml_bytes = kml_content.encode("utf-8")
+        if kml_bytes.startswith(_STATIC_PREFIX):
+            if self._prefix_deflate is None:
+                compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+                prefix_out = compressor.compress(_STATIC_PREFIX)
+                prefix_out += compressor.flush(zlib.Z_FULL_FLUSH)
+                self._prefix_deflate = (prefix_out, compressor)
+            prefix_out, compressor = self._prefix_deflate
+            tail = compressor.copy()
+            compressed = prefix_out + tail.compress(
+                kml_bytes[len(_STATIC_PREFIX):]
+            )
+            compressed += tail.flush()
+        else:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+            compressed = compressor.compress(kml_bytes) + compressor.flush()
+        return _build_kmz(compressed, zlib.crc32(kml_bytes), len(kml_bytes))
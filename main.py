@@ -0,0 +1,54 @@
+"""Entry point wiring the firehose client to the KMZ web server."""
+
+import argparse
+import time
+
+from kmz_generator import OptimizedKMZGenerator
+from planefinder_client import DataProcessor, FirehoseClient
+from web_server import OptimizedKMZServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planefinder firehose KMZ server")
+    parser.add_argument("--firehose-host", default="firehose.planefinder.net")
+    parser.add_argument("--firehose-port", type=int, default=9011)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7305)
+    parser.add_argument("--external-url", default=None)
+    parser.add_argument("--persistence-time", type=float, default=60.0)
+    args = parser.parse_args()
+
+    kmz_generator = OptimizedKMZGenerator(persistence_time=args.persistence_time)
+    processor = DataProcessor()
+    processor.add_callback(kmz_generator.update_aircraft_data)
+
+    client = FirehoseClient(args.firehose_host, args.firehose_port)
+    client.set_payload_callback(processor.process_aircraft_data)
+
+    server = OptimizedKMZServer(
+        kmz_generator,
+        host=args.host,
+        port=args.port,
+        external_url=args.external_url,
+    )
+
+    server.start()
+    client.start()
+    try:
+        while True:
+            time.sleep(30)
+            status = kmz_generator.get_system_status()
+            print(
+                f"Tracking {status['aircraft_count']} aircraft, "
+                f"{status['update_count']} updates, "
+                f"last update {status['last_update']}"
+            )
+    except KeyboardInterrupt:
+        print("Shutting down")
+    finally:
+        client.stop()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
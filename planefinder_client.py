@@ -0,0 +1,320 @@
+"""Client for the Planefinder ADS-B firehose feed.
+
+Maintains a TCP connection to the firehose endpoint, extracts DLE-framed
+messages from the stream, decompresses gzip payloads and hands decoded
+aircraft dictionaries to registered callbacks.
+"""
+
+import asyncio
+import json
+import socket
+import ssl
+import threading
+import zlib
+
+try:
+    # ISA-L's SIMD-accelerated zlib; wbits=31 selects gzip framing.
+    from isal import isal_zlib as _isal_zlib
+except ImportError:
+    _isal_zlib = None
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+# Both parsers take the payload bytes directly, avoiding a separate
+# UTF-8 decode pass over every frame.
+_json_loads = _orjson.loads if _orjson is not None else json.loads
+
+try:
+    # Compiled frame parser (see dle_parser.pyx / setup.py).
+    from dle_parser import extract_frames as _extract_frames
+except ImportError:
+    _extract_frames = None
+
+if _isal_zlib is not None:
+    def _gzip_decompress(data):
+        return _isal_zlib.decompress(data, wbits=31)
+else:
+    def _gzip_decompress(data):
+        # zlib with wbits=31 parses the gzip header directly, skipping
+        # the GzipFile object gzip.decompress builds for every call.
+        decompressor = zlib.decompressobj(wbits=31)
+        return decompressor.decompress(data) + decompressor.flush()
+
+# Everything a corrupt frame can raise out of decompression or JSON
+# parsing.  zlib.error is not an OSError (unlike gzip's BadGzipFile),
+# and ISA-L raises its own error type, so both must be caught
+# explicitly or one bad frame after a resync glitch kills the client.
+_DECODE_ERRORS = (OSError, ValueError, zlib.error)
+if _isal_zlib is not None:
+    _DECODE_ERRORS += (_isal_zlib.error,)
+
+# Bound on connect and on each read, matching the socket timeout the
+# blocking client used: the feed ticks every few seconds, so half a
+# minute of silence means the connection is dead (half-open after a NAT
+# drop or a peer that died without a FIN) and must be re-established.
+SOCKET_TIMEOUT = 30.0
+
+DLE = 0x10
+STX = 0x02
+ETX = 0x03
+
+
+class DLEProtocol:
+    """DLE/STX ... DLE/ETX framing with DLE byte stuffing.
+
+    Frames on the wire look like ``10 02 <payload> 10 03`` where any
+    literal ``10`` byte inside the payload is doubled (``10 10``).
+    """
+
+    @staticmethod
+    def extract_frames(buffer):
+        """Extract complete frames from *buffer*.
+
+        Returns ``(frames, consumed)`` where *frames* is a list of
+        unstuffed payload ``bytes`` objects and *consumed* is the index
+        of the first unconsumed byte (the start of a partial frame, if
+        any), letting the caller trim its buffer in place.
+
+        Scanning is done with ``find`` so the per-byte work runs in C
+        rather than the interpreter loop; unstuffing is a single
+        ``replace`` over the frame body.
+        """
+        frames = []
+        pos = 0
+        n = len(buffer)
+        while True:
+            start = buffer.find(b"\x10\x02", pos)
+            if start < 0:
+                # No frame start left; keep a trailing DLE in case the
+                # STX arrives in the next chunk.
+                pos = n - 1 if n and buffer[n - 1] == DLE else n
+                break
+            # Find the real terminator: a DLE/ETX whose DLE is not the
+            # second half of a stuffed DLE/DLE pair.  A candidate is a
+            # true terminator when the run of consecutive DLE bytes
+            # ending at it has odd length.
+            search = start + 2
+            end = -1
+            while True:
+                candidate = buffer.find(b"\x10\x03", search)
+                if candidate < 0:
+                    break
+                run_start = candidate
+                while run_start > start + 1 and buffer[run_start - 1] == DLE:
+                    run_start -= 1
+                if (candidate - run_start + 1) % 2 == 1:
+                    end = candidate
+                    break
+                search = candidate + 2
+            if end < 0:
+                # Partial frame at the end of the buffer.
+                pos = start
+                break
+            frames.append(bytes(buffer[start + 2 : end]).replace(b"\x10\x10", b"\x10"))
+            pos = end + 2
+        return frames, pos
+
+
+if _extract_frames is None:
+    _extract_frames = DLEProtocol.extract_frames
+
+
+class FirehoseClient:
+    """Connects to the firehose feed and decodes payloads.
+
+    Runs an asyncio event loop on a dedicated daemon thread: recv,
+    frame extraction and the payload callback all execute back-to-back
+    in one task with no thread hop per frame, and the connection is
+    re-established automatically when it drops.
+    """
+
+    def __init__(self, host, port, use_ssl=True, reconnect_delay=5.0):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.reconnect_delay = reconnect_delay
+        self.buffer = bytearray()
+        self.running = False
+        self.payload_callback = None
+        self._thread = None
+        self._loop = None
+        self._writer = None
+
+    def set_payload_callback(self, callback):
+        """Register the function that receives each decoded payload."""
+        self.payload_callback = callback
+
+    def start(self):
+        """Start the client thread."""
+        if self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._run_thread, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the client and close the connection."""
+        self.running = False
+        loop = self._loop
+        writer = self._writer
+        if loop is not None and writer is not None:
+            loop.call_soon_threadsafe(writer.close)
+
+    def _run_thread(self):
+        asyncio.run(self._run_client())
+
+    async def _run_client(self):
+        self._loop = asyncio.get_running_loop()
+        while self.running:
+            try:
+                await self._connect_and_run()
+            except (OSError, ssl.SSLError, asyncio.TimeoutError) as exc:
+                print(f"Firehose connection error: {exc}")
+            if self.running:
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _connect_and_run(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context),
+            SOCKET_TIMEOUT,
+        )
+        self._writer = writer
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # The feed is a steady trickle of small frames; don't let
+            # Nagle hold any of it back.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"Connected to firehose at {self.host}:{self.port}")
+        self.buffer = bytearray()
+        try:
+            while self.running:
+                try:
+                    data = await asyncio.wait_for(
+                        reader.read(65536), SOCKET_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    print("Firehose read timed out; reconnecting")
+                    break
+                if not data:
+                    print("Firehose connection closed by remote end")
+                    break
+                self.buffer += data
+                self._process_buffer()
+        finally:
+            writer.close()
+            self._writer = None
+
+    def _process_buffer(self):
+        frames, consumed = _extract_frames(self.buffer)
+        if consumed:
+            del self.buffer[:consumed]
+        for frame in frames:
+            try:
+                if frame[:2] == b"\x1f\x8b":
+                    payload = _json_loads(_gzip_decompress(frame))
+                else:
+                    payload = _json_loads(frame)
+            except _DECODE_ERRORS as exc:
+                print(f"Failed to decode frame ({len(frame)} bytes): {exc}")
+                continue
+            if self.payload_callback is not None:
+                self.payload_callback(payload)
+
+
+class DataProcessor:
+    """Normalizes firehose payloads and applies configured filters.
+
+    Filters are a dict with any of the keys ``min_altitude``,
+    ``max_altitude``, ``min_speed``, ``max_speed``, ``bounds`` (a
+    ``(min_lat, min_lon, max_lat, max_lon)`` tuple).  Aircraft that pass
+    the filters are handed to registered callbacks as a list of dicts.
+    """
+
+    def __init__(self, filters=None):
+        self.filters = dict(filters) if filters else {}
+        # Held as an immutable tuple: registration replaces the whole
+        # tuple, so dispatch can iterate it without synchronization even
+        # though callbacks fire on the client's event-loop thread.
+        self._callbacks = ()
+        self.payload_count = 0
+        self._predicate = self._compile_predicate()
+
+    def add_callback(self, callback):
+        """Register a function called with each filtered aircraft list."""
+        self._callbacks = self._callbacks + (callback,)
+
+    def update_filters(self, filters):
+        """Replace the active filter set."""
+        self.filters = dict(filters) if filters else {}
+        self._predicate = self._compile_predicate()
+
+    def _compile_predicate(self):
+        """Build a predicate function specialized on the active filters.
+
+        Generates source containing only the checks that are actually
+        configured (with the limits baked in as constants) and compiles
+        it once, so the per-aircraft call does no dict probes for
+        filters that are not set.
+        """
+        filters = self.filters
+        lines = ["def _predicate(aircraft):"]
+        if "min_altitude" in filters or "max_altitude" in filters:
+            lines.append("    altitude = aircraft.get('altitude')")
+            lines.append("    if altitude is None:")
+            lines.append("        return False")
+            if "min_altitude" in filters:
+                lines.append(f"    if altitude < {filters['min_altitude']!r}:")
+                lines.append("        return False")
+            if "max_altitude" in filters:
+                lines.append(f"    if altitude > {filters['max_altitude']!r}:")
+                lines.append("        return False")
+        if "min_speed" in filters or "max_speed" in filters:
+            lines.append("    speed = aircraft.get('speed')")
+            lines.append("    if speed is None:")
+            lines.append("        return False")
+            if "min_speed" in filters:
+                lines.append(f"    if speed < {filters['min_speed']!r}:")
+                lines.append("        return False")
+            if "max_speed" in filters:
+                lines.append(f"    if speed > {filters['max_speed']!r}:")
+                lines.append("        return False")
+        if "bounds" in filters:
+            min_lat, min_lon, max_lat, max_lon = filters["bounds"]
+            lines.append("    lat = aircraft.get('lat')")
+            lines.append("    lon = aircraft.get('lon')")
+            lines.append("    if lat is None or lon is None:")
+            lines.append("        return False")
+            lines.append(
+                f"    if not ({min_lat!r} <= lat <= {max_lat!r}"
+                f" and {min_lon!r} <= lon <= {max_lon!r}):"
+            )
+            lines.append("        return False")
+        lines.append("    return True")
+        namespace = {}
+        exec(compile("\n".join(lines), "<filter-predicate>", "exec"), {}, namespace)
+        return namespace["_predicate"]
+
+    def process_aircraft_data(self, payload):
+        """Normalize *payload* and dispatch filtered aircraft to callbacks."""
+        self.payload_count += 1
+        aircraft_list = []
+        for aircraft_id, fields in payload.items():
+            if not isinstance(fields, dict):
+                continue
+            aircraft = {
+                "aircraft_id": aircraft_id,
+                "callsign": (fields.get("callsign") or "").strip(),
+                "lat": fields.get("lat"),
+                "lon": fields.get("lon"),
+                "altitude": fields.get("altitude"),
+                "speed": fields.get("speed"),
+                "heading": fields.get("heading"),
+            }
+            if self._predicate(aircraft):
+                aircraft_list.append(aircraft)
+        for callback in self._callbacks:
+            callback(aircraft_list)
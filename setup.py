@@ -0,0 +1,17 @@
+"""Optional build of the Cython frame-parser extension.
+
+Run ``python setup.py build_ext --inplace`` with Cython installed to
+build dle_parser; everything works without it via the pure-Python
+fallback.
+"""
+
+from setuptools import setup
+
+try:
+    from Cython.Build import cythonize
+
+    ext_modules = cythonize("dle_parser.pyx")
+except ImportError:
+    ext_modules = []
+
+setup(name="planefinder-kml", ext_modules=ext_modules)
@@ -0,0 +1,428 @@
+"""Minimal HTTP server exposing the aircraft database as KMZ.
+
+Endpoints:
+  /           and /live.kmz  -- NetworkLink wrapper KMZ for Google Earth
+  /aircraft.kmz              -- the live aircraft KMZ, refreshed each poll
+  /status                    -- JSON status summary
+  /test                      -- small HTML sanity page
+"""
+
+import gzip
+import itertools
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+if _orjson is not None:
+    # Returns bytes directly, skipping the str build + encode pass.
+    _json_dumps = _orjson.dumps
+else:
+    # stdlib json is only pulled in when orjson is unavailable, keeping
+    # it off the import path (and out of RSS) everywhere else.
+    import json
+
+    def _json_dumps(data):
+        return json.dumps(data).encode("utf-8")
+
+# Second-resolution timestamp for request logging, refreshed by a 1 Hz
+# daemon so log lines read a cached string instead of paying a
+# datetime.now() + strftime per logged request.  Held in a one-element
+# list so the daemon's update is a plain (atomic) item store.
+_now_str = [time.strftime("%H:%M:%S")]
+
+# sendmsg(2) takes an iovec, letting header and body go out in one
+# syscall without concatenating them first; absent on some platforms.
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Endpoint paths as interned constants: the routes table keys on these,
+# so lookups for the short, hot paths short-circuit on pointer identity
+# whenever CPython hands us an interned request target.
+_ROOT = sys.intern("/")
+_LIVE = sys.intern("/live.kmz")
+_AIRCRAFT = sys.intern("/aircraft.kmz")
+_STATUS = sys.intern("/status")
+_TEST = sys.intern("/test")
+
+# /test page as a bytes template: only the two counters are formatted
+# per request, with no intermediate str or encode pass.
+_TEST_HTML = (
+    b"<html><head><title>Planefinder KMZ</title></head>"
+    b"<body><h1>Planefinder KMZ server</h1>"
+    b"<p>Aircraft tracked: %d</p>"
+    b"<p>Requests served: %d</p>"
+    b'<p><a href="/live.kmz">live.kmz</a></p>'
+    b"</body></html>"
+)
+_clock_thread = None
+
+
+def _clock_loop():
+    while True:
+        time.sleep(1.0)
+        _now_str[0] = time.strftime("%H:%M:%S")
+
+
+def _ensure_clock():
+    global _clock_thread
+    if _clock_thread is None:
+        _clock_thread = threading.Thread(target=_clock_loop, daemon=True)
+        _clock_thread.start()
+
+
+class _Server(ThreadingHTTPServer):
+    """Thread-per-request server so one slow client can't stall the rest.
+
+    Daemon threads and block_on_close=False keep shutdown prompt even
+    with Google Earth clients holding connections open.
+    """
+
+    daemon_threads = True
+    block_on_close = False
+
+    def server_bind(self):
+        # SO_REUSEADDR comes from HTTPServer; SO_REUSEPORT additionally
+        # sidesteps TIME_WAIT races on quick restarts where supported.
+        if hasattr(socket, "SO_REUSEPORT"):
+            try:
+                self.socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEPORT, 1
+                )
+            except OSError:
+                pass
+        super().server_bind()
+
+
+class MinimalKMZHandler(BaseHTTPRequestHandler):
+    """Request handler backed by the owning OptimizedKMZServer.
+
+    Defined at module scope (rather than as a closure inside the server)
+    so handler methods resolve state through ``self.server.app`` — the
+    OptimizedKMZServer stashed on the HTTP server at start() — instead
+    of closure free variables.
+    """
+
+    # HTTP/1.1 keeps Google Earth's poll connection open between
+    # refreshes, dropping the TCP handshake from every poll.
+    # Every response path below emits Content-Length, which is
+    # what makes persistent connections legal without chunking.
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Responses are single small KMZ blobs; never let Nagle
+        # hold the tail segment back, and give the kernel room
+        # to take the whole response in one write.
+        self.connection.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+        try:
+            self.connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, 262144
+            )
+        except OSError:
+            pass
+
+    def do_GET(self):
+        # The endpoint set is fixed and none of our paths carry a
+        # query string in normal use, so a find/slice replaces
+        # urlparse (which builds a ParseResult per request) and a
+        # dict probe replaces the string-compare chain.
+        raw = self.path
+        query_start = raw.find("?")
+        path = raw if query_start < 0 else raw[:query_start]
+        app = self.server.app
+        app.request_count = next(app._request_counter)
+        handler = self._routes.get(path)
+        if handler is not None:
+            handler(self)
+        else:
+            self._send_error_response(404, "Not found")
+
+    def _handle_live(self):
+        app = self.server.app
+        kmz_data = app._get_cached_kmz("/live.kmz", app._base_url)
+        self._send_kmz_response(kmz_data, "live.kmz")
+
+    def _handle_aircraft(self):
+        app = self.server.app
+        # The sampling block touches the KML render and the aircraft
+        # snapshot purely for diagnostics, so it only runs when
+        # KMZ_DEBUG is set, and the __debug__ guard lets python -O drop
+        # it from the bytecode entirely.
+        if __debug__ and app.debug and app.request_count % 20 == 0:
+            import logging
+
+            kmz_gen = app.kmz_generator
+            kmz_gen.generate_minimal_kml()
+            current = kmz_gen.get_current_aircraft()
+            if current:
+                sample = current[0]
+                logging.debug(
+                    "Serving %d aircraft, %d predictions; sample %s alt=%d hdg=%s",
+                    len(current),
+                    kmz_gen.last_prediction_count,
+                    sample.get("callsign", "?"),
+                    round((sample.get("altitude") or 0) / 100),
+                    sample.get("heading"),
+                )
+        kmz_data = app._get_cached_kmz("/aircraft.kmz")
+        self._send_kmz_response(kmz_data, "aircraft.kmz")
+
+    def _handle_status(self):
+        app = self.server.app
+        status = app.kmz_generator.get_system_status()
+        status["request_count"] = app.request_count
+        self._send_json_response(status)
+
+    def _handle_test(self):
+        app = self.server.app
+        aircraft_count = len(app.kmz_generator.get_current_aircraft())
+        body = _TEST_HTML % (aircraft_count, app.request_count)
+        self._send_html_response(body)
+
+    _routes = {
+        _ROOT: _handle_live,
+        _LIVE: _handle_live,
+        _AIRCRAFT: _handle_aircraft,
+        _STATUS: _handle_status,
+        _TEST: _handle_test,
+    }
+
+    def _send_full_response(self, code, message, headers, body):
+        # Status line, headers and body go out in a single
+        # write: one syscall and one TCP segment for these small
+        # responses instead of three or four.
+        self.log_request(code)
+        head = [
+            f"{self.protocol_version} {code} {message}\r\n",
+            f"Server: {self.version_string()}\r\n",
+            f"Date: {self.date_time_string()}\r\n",
+        ]
+        head.extend(f"{name}: {value}\r\n" for name, value in headers)
+        head.append("\r\n")
+        head_bytes = "".join(head).encode("latin-1")
+        if len(body) < 8192:
+            self.wfile.write(head_bytes + body)
+        elif _HAS_SENDMSG:
+            # Large cached KMZ blobs are shared across requests; an
+            # iovec send gathers header and body in the kernel with no
+            # userspace concat copy.
+            self._sendmsg_all(head_bytes, body)
+        else:
+            self.wfile.write(head_bytes)
+            self.wfile.write(memoryview(body))
+
+    def _sendmsg_all(self, head, body):
+        # wfile is unbuffered (wbufsize 0), so writing straight to the
+        # connection socket here cannot reorder against it.
+        sock = self.connection
+        buffers = [memoryview(head), memoryview(body)]
+        while buffers:
+            sent = sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                del buffers[0]
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+
+    def _send_kmz_response(self, kmz_data, filename):
+        self._send_full_response(
+            200,
+            "OK",
+            (
+                ("Content-Type", "application/vnd.google-earth.kmz"),
+                (
+                    "Content-Disposition",
+                    f'attachment; filename="{filename}"',
+                ),
+                ("Content-Length", str(len(kmz_data))),
+            ),
+            kmz_data,
+        )
+
+    def _compress_if_accepted(self, body, headers):
+        # KMZ is already deflated and never comes through here;
+        # JSON/HTML compress well and these polls may ride a
+        # cellular link.  Level 1 keeps the CPU cost trivial.
+        if len(body) >= 128 and "gzip" in self.headers.get(
+            "Accept-Encoding", ""
+        ):
+            body = gzip.compress(body, compresslevel=1)
+            headers.append(("Content-Encoding", "gzip"))
+        return body
+
+    def _send_json_response(self, data):
+        body = _json_dumps(data)
+        headers = [("Content-Type", "application/json")]
+        body = self._compress_if_accepted(body, headers)
+        headers.append(("Content-Length", str(len(body))))
+        self._send_full_response(200, "OK", headers, body)
+
+    def _send_html_response(self, body):
+        headers = [("Content-Type", "text/html")]
+        body = self._compress_if_accepted(body, headers)
+        headers.append(("Content-Length", str(len(body))))
+        self._send_full_response(200, "OK", headers, body)
+
+    def _send_error_response(self, code, message):
+        body = message.encode("utf-8")
+        self._send_full_response(
+            code,
+            message,
+            (
+                ("Content-Type", "text/plain"),
+                ("Content-Length", str(len(body))),
+            ),
+            body,
+        )
+
+    def log_message(self, format, *args):
+        if self.server.app.request_count % 10 == 0:
+            print(f"[{_now_str[0]}] {self.address_string()} {format % args}")
+
+
+class OptimizedKMZServer:
+    """Serves KMZ documents generated by an OptimizedKMZGenerator."""
+
+    def __init__(
+        self,
+        kmz_generator,
+        host="0.0.0.0",
+        port=7305,
+        external_url=None,
+        compresslevel=None,
+        cpu_affinity=None,
+    ):
+        self.kmz_generator = kmz_generator
+        self.host = host
+        self.port = port
+        self.external_url = external_url
+        # Pin the accept loop (and, via SO_INCOMING_CPU, the kernel's
+        # steering of accepted connections) to one CPU so it stops
+        # bouncing across cores.  For full effect the NIC IRQ should be
+        # pinned to the same core operationally:
+        #   echo <cpu> > /proc/irq/<nic-irq>/smp_affinity_list
+        self.cpu_affinity = cpu_affinity
+        # host/port/external_url never change after construction, so the
+        # NetworkLink base URL is fixed here rather than rebranched on
+        # every /live.kmz hit.
+        if external_url:
+            self._base_url = external_url
+        elif host == "0.0.0.0":
+            self._base_url = "http://139.162.173.89:7305"
+        else:
+            self._base_url = f"http://{host}:{port}"
+        if compresslevel is not None:
+            # Live serving wants the generator's fast default; offline
+            # or archival use can ask for a higher tier here.
+            kmz_generator.set_compresslevel(compresslevel)
+        # next() on an itertools.count increments in C under a single
+        # bytecode, so concurrent handler threads never lose a count;
+        # request_count holds the latest value for display.
+        self._request_counter = itertools.count(1)
+        self.request_count = 0
+        self.debug = bool(os.environ.get("KMZ_DEBUG"))
+        if self.debug:
+            # The root logger defaults to WARNING, which would swallow
+            # the sampling diagnostics; opt into DEBUG only when the
+            # flag asks for them.
+            import logging
+
+            logging.basicConfig(level=logging.DEBUG)
+        self.server = None
+        self._thread = None
+        self._producer_thread = None
+        self._running = False
+        # KMZ bytes cached per path, invalidated when the generator's
+        # data version moves: N concurrent polls cost one generation.
+        self._cache = {}
+        self._cache_version = -1
+        self._cache_lock = threading.Lock()
+
+    def _producer_loop(self):
+        """Rebuild both KMZ blobs as soon as the generator has new data.
+
+        Pre-warming the cache here moves the KML build + deflate off the
+        request threads: after a data change the next poll finds the
+        blobs already built instead of paying for them in-line.
+        _get_cached_kmz stays as the fallback for a cold cache.
+        """
+        event = self.kmz_generator.data_changed
+        base_url = self._base_url
+        while self._running:
+            if not event.wait(timeout=1.0):
+                continue
+            event.clear()
+            try:
+                self._get_cached_kmz("/live.kmz", base_url)
+                self._get_cached_kmz("/aircraft.kmz")
+            except Exception as exc:
+                print(f"KMZ producer error: {exc}")
+
+    def _get_cached_kmz(self, path, base_url=None):
+        """Return the KMZ bytes for *path*, regenerating only on change."""
+        generator = self.kmz_generator
+        version = generator.version()
+        with self._cache_lock:
+            if version != self._cache_version:
+                self._cache.clear()
+                self._cache_version = version
+            kmz_data = self._cache.get(path)
+        if kmz_data is None:
+            if path == "/live.kmz":
+                kml_content = generator.generate_main_kml(base_url)
+            else:
+                kml_content = generator.generate_minimal_kml()
+            kmz_data = generator.create_kmz_from_kml(kml_content)
+            with self._cache_lock:
+                if self._cache_version == version:
+                    self._cache[path] = kmz_data
+        return kmz_data
+
+
+    def start(self):
+        """Start the HTTP server on a background thread."""
+        _ensure_clock()
+        self.server = _Server((self.host, self.port), MinimalKMZHandler)
+        # Handlers reach back to this instance through self.server.app;
+        # set it before serve_forever picks up any connection.
+        self.server.app = self
+        if self.cpu_affinity is not None and hasattr(socket, "SO_INCOMING_CPU"):
+            try:
+                self.server.socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_INCOMING_CPU, self.cpu_affinity
+                )
+            except OSError:
+                pass
+        self._running = True
+        self._producer_thread = threading.Thread(
+            target=self._producer_loop, daemon=True
+        )
+        self._producer_thread.start()
+        self._thread = threading.Thread(target=self._run_server, daemon=True)
+        self._thread.start()
+        print(f"KMZ server listening on {self.host}:{self.port}")
+
+    def _run_server(self):
+        if self.cpu_affinity is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, {self.cpu_affinity})
+            except OSError:
+                pass
+        self.server.serve_forever()
+
+    def stop(self):
+        """Shut the server down."""
+        self._running = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
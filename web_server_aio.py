@@ -0,0 +1,203 @@
+"""Asyncio variant of the KMZ server, built on aiohttp.
+
+Serves the same endpoints as web_server.OptimizedKMZServer but handles
+all connections on one event-loop thread, so thousands of long-poll
+Google Earth clients cost a socket each instead of a thread each.
+Requires aiohttp; uvloop is picked up automatically when installed.
+"""
+
+import asyncio
+import threading
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+if _orjson is not None:
+    _json_dumps = _orjson.dumps
+else:
+    import json
+
+    def _json_dumps(data):
+        return json.dumps(data).encode("utf-8")
+
+KMZ_CONTENT_TYPE = "application/vnd.google-earth.kmz"
+
+
+class AsyncKMZServer:
+    """aiohttp front end for an OptimizedKMZGenerator.
+
+    Keeps the same version-keyed KMZ cache and eager producer as the
+    threaded server: the producer task rebuilds both blobs when the
+    generator signals new data, so request handlers only hand out
+    cached bytes.
+    """
+
+    def __init__(
+        self,
+        kmz_generator,
+        host="0.0.0.0",
+        port=7305,
+        external_url=None,
+        compresslevel=None,
+    ):
+        if web is None:
+            raise ImportError(
+                "aiohttp is required for AsyncKMZServer; install it or "
+                "use web_server.OptimizedKMZServer instead"
+            )
+        self.kmz_generator = kmz_generator
+        self.host = host
+        self.port = port
+        self.external_url = external_url
+        # host/port/external_url are immutable after construction, so
+        # the NetworkLink base URL is fixed once here.
+        if external_url:
+            self._base_url = external_url
+        elif host == "0.0.0.0":
+            self._base_url = "http://139.162.173.89:7305"
+        else:
+            self._base_url = f"http://{host}:{port}"
+        if compresslevel is not None:
+            kmz_generator.set_compresslevel(compresslevel)
+        self.request_count = 0
+        self._cache = {}
+        self._cache_version = -1
+        self._thread = None
+        self._loop = None
+        self._running = False
+
+    def _get_cached_kmz(self, path):
+        """Return the KMZ bytes for *path*, regenerating only on change.
+
+        Runs on the event-loop thread; generation is cheap once the
+        generator's own render caches are warm, and the producer task
+        keeps this cache warm for the common case anyway.
+        """
+        generator = self.kmz_generator
+        version = generator.version()
+        if version != self._cache_version:
+            self._cache.clear()
+            self._cache_version = version
+        kmz_data = self._cache.get(path)
+        if kmz_data is None:
+            if path == "/live.kmz":
+                kml_content = generator.generate_main_kml(self._base_url)
+            else:
+                kml_content = generator.generate_minimal_kml()
+            kmz_data = generator.create_kmz_from_kml(kml_content)
+            self._cache[path] = kmz_data
+        return kmz_data
+
+    async def _producer(self):
+        """Rebuild both KMZ blobs whenever the generator has new data."""
+        event = self.kmz_generator.data_changed
+        loop = asyncio.get_running_loop()
+        while self._running:
+            # data_changed is a threading.Event set from the generator's
+            # flush thread; wait for it off-loop so the loop stays free.
+            signalled = await loop.run_in_executor(None, event.wait, 1.0)
+            if not signalled:
+                continue
+            event.clear()
+            try:
+                self._get_cached_kmz("/live.kmz")
+                self._get_cached_kmz("/aircraft.kmz")
+            except Exception as exc:
+                print(f"KMZ producer error: {exc}")
+
+    def _kmz_response(self, kmz_data, filename):
+        return web.Response(
+            body=kmz_data,
+            content_type=KMZ_CONTENT_TYPE,
+            headers={
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            },
+        )
+
+    async def _handle_live(self, request):
+        self.request_count += 1
+        return self._kmz_response(self._get_cached_kmz("/live.kmz"), "live.kmz")
+
+    async def _handle_aircraft(self, request):
+        self.request_count += 1
+        return self._kmz_response(
+            self._get_cached_kmz("/aircraft.kmz"), "aircraft.kmz"
+        )
+
+    async def _handle_status(self, request):
+        self.request_count += 1
+        status = self.kmz_generator.get_system_status()
+        status["request_count"] = self.request_count
+        return web.Response(
+            body=_json_dumps(status), content_type="application/json"
+        )
+
+    async def _handle_test(self, request):
+        self.request_count += 1
+        aircraft_count = len(self.kmz_generator.get_current_aircraft())
+        html = (
+            "<html><head><title>Planefinder KMZ</title></head>"
+            "<body><h1>Planefinder KMZ server (asyncio)</h1>"
+            f"<p>Aircraft tracked: {aircraft_count}</p>"
+            f"<p>Requests served: {self.request_count}</p>"
+            '<p><a href="/live.kmz">live.kmz</a></p>'
+            "</body></html>"
+        )
+        return web.Response(text=html, content_type="text/html")
+
+    def _build_app(self):
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/", self._handle_live),
+                web.get("/live.kmz", self._handle_live),
+                web.get("/aircraft.kmz", self._handle_aircraft),
+                web.get("/status", self._handle_status),
+                web.get("/test", self._handle_test),
+            ]
+        )
+        return app
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        runner = web.AppRunner(self._build_app())
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port)
+        await site.start()
+        print(f"Async KMZ server listening on {self.host}:{self.port}")
+        producer = asyncio.ensure_future(self._producer())
+        try:
+            while self._running:
+                await asyncio.sleep(1.0)
+        finally:
+            producer.cancel()
+            await runner.cleanup()
+
+    def _run_thread(self):
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(self._serve())
+
+    def start(self):
+        """Start the event loop on a background thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run_thread, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server and its event loop."""
+        self._running = False